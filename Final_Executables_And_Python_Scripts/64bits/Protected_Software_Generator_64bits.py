@@ -1,6 +1,11 @@
 import angr
+import bisect
+import functools
+import mmap
 import os
 import shutil
+import struct
+from capstone import CS_GRP_CALL, CS_GRP_JUMP, CS_OP_MEM, CS_OP_REG, x86
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 import hashlib
@@ -12,6 +17,17 @@ import lief
 dir = ""
 iv = b'\xC2\x40\xEC\xD0\x63\x63\x62\xDF\xBF\xD3\xB8\xF2\x7C\x3B\x80\x02'
 hash_function = hashlib.sha256  # RFC5869 also includes SHA-1 test vectors
+hash_length = hash_function().digest_size
+backend = default_backend()
+ctr_mode = modes.CTR(iv)  # Every block uses the same IV, so the mode object is shared
+DEBUG = False  # Print the per-block addresses and keys while encrypting
+# General purpose registers that make a jump or call target dynamic
+DYNAMIC_REGS = frozenset([
+    x86.X86_REG_RAX, x86.X86_REG_RBX, x86.X86_REG_RCX, x86.X86_REG_RDX,
+    x86.X86_REG_RSI, x86.X86_REG_RDI, x86.X86_REG_RSP, x86.X86_REG_RBP,
+    x86.X86_REG_R8, x86.X86_REG_R9, x86.X86_REG_R10, x86.X86_REG_R11,
+    x86.X86_REG_R12, x86.X86_REG_R13, x86.X86_REG_R14, x86.X86_REG_R15,
+])
 
 
 """
@@ -36,6 +52,7 @@ def get_image_base(file_name):
 @param exe_file_path: Path to the executable file.
 @return: A tuple containing the start and end addresses of the .text section.
 """
+@functools.lru_cache(maxsize=None)
 def get_text_section_addresses(exe_file_path):
     # Load the executable file
     binary = lief.parse(exe_file_path)
@@ -58,6 +75,7 @@ def get_text_section_addresses(exe_file_path):
 @param file_name: Path to the PE file.
 @return: Virtual address of the .text section as a hexadecimal string, or None if not found or an error occurs.
 """
+@functools.lru_cache(maxsize=None)
 def get_text_section_virtual_address(file_name):
     try:
         pe = pefile.PE(file_name, fast_load=True)  # Load the PE file in fast_load mode
@@ -76,13 +94,12 @@ def get_text_section_virtual_address(file_name):
         return None
 
 """
-@brief Prints a byte object in hexadecimal format.
+@brief Prints a byte object in hexadecimal format when DEBUG is enabled.
 @param byte_obj The byte object to be printed in hexadecimal format.
 """
 def print_hex_format(byte_obj):
-    hex_string = byte_obj.hex()
-    formatted_hex = ' '.join(hex_string[i:i+2] for i in range(0, len(hex_string), 2))
-    print(formatted_hex)
+    if DEBUG:
+        print(byte_obj.hex(' '))
 
 """
 @brief Computes the HMAC digest of the given key and data.
@@ -101,7 +118,7 @@ def hmac_digest(key: bytes, data: bytes) -> bytes:
 """
 def hkdf_extract(salt: bytes, ikm: bytes) -> bytes:
     if len(salt) == 0:
-        salt = bytes([0] * hash_function().digest_size)
+        salt = bytes([0] * hash_length)
     return hmac_digest(salt, ikm)
 
 """
@@ -112,14 +129,21 @@ def hkdf_extract(salt: bytes, ikm: bytes) -> bytes:
 @return The output keying material.
 """
 def hkdf_expand(prk: bytes, info: bytes, length: int) -> bytes:
+    # A single block T(1) is enough when the output fits in one digest (always the case for AES keys)
+    if length <= hash_length:
+        return hmac_digest(prk, info + b"\x01")[:length]
+    # Key the HMAC once and copy its state for every T(i) instead of re-keying each iteration
+    base = hmac.new(prk, digestmod=hash_function)
     t = b""
-    okm = b""
+    okm = bytearray()
     i = 0
     while len(okm) < length:
         i += 1
-        t = hmac_digest(prk, t + info + bytes([i]))
+        h = base.copy()
+        h.update(t + info + bytes([i]))
+        t = h.digest()
         okm += t
-    return okm[:length]
+    return bytes(okm[:length])
 
 """
 @brief Performs the complete HKDF key derivation.
@@ -133,20 +157,38 @@ def hkdf(salt: bytes, ikm: bytes, info: bytes, length: int) -> bytes:
     prk = hkdf_extract(salt, ikm)
     return hkdf_expand(prk, info, length)
 
+"""
+@brief Loads a binary file into an angr Project.
+@param binary_path The path to the binary file.
+@return An angr Project object for the binary.
+"""
+def load_project(binary_path):
+    return angr.Project(binary_path, auto_load_libs=False)
+
+"""
+@brief Builds the CFG used by the block and dynamic jump analyses.
+@param project An angr Project object representing the binary.
+@return The CFGFast result for the project.
+"""
+def build_cfg(project):
+    # The default CFGFast options are kept. Turning off indirect jump resolution would leave jump table
+    # targets unsplit, and turning off data references would lose code that is only reached through
+    # data pointers, so those blocks would never be found or encrypted.
+    return project.analyses.CFGFast()
+
 """
 @brief Retrieves relocation addresses from a binary file.
 @param binary_path The path to the binary file.
+@param project An already loaded angr Project for the binary (optional).
 @return A sorted list of relocation addresses.
 """
-def get_relocation_addresses(binary_path):
-    project = angr.Project(binary_path, auto_load_libs=False)
+def get_relocation_addresses(binary_path, project=None):
+    if project is None:
+        project = load_project(binary_path)
     main_object = project.loader.main_object
     image_base = main_object.min_addr
-    relocation_addresses = set()
-    for reloc in main_object.relocs:
-        if reloc.symbol is None:
-            relocation_addresses.add(reloc.rebased_addr - image_base)
-    return sorted(list(relocation_addresses))
+    relocation_addresses = {reloc.rebased_addr - image_base for reloc in main_object.relocs if reloc.symbol is None}
+    return sorted(relocation_addresses)
 
 """
 @brief Filters basic block ranges based on relocation addresses.
@@ -155,11 +197,17 @@ def get_relocation_addresses(binary_path):
 @return A filtered list of address ranges.
 """
 def filter_blocks_by_relocations(ranges, relocation_addresses):
+    # The binary search below needs sorted input; this is linear when the list is already sorted
+    relocation_addresses = sorted(relocation_addresses)
     filtered_ranges = []
     for start, end in ranges:
         block_size = end - start
         expected_relocs = block_size // 8  # Changed from 4 to 8 for 64-bit
-        relocs_in_block = sum(1 for addr in relocation_addresses if start <= addr < end)
+        # A block shorter than 8 bytes expects no relocations, so it can never pass the check below
+        if expected_relocs == 0:
+            continue
+        # Number of relocations in [start, end), found by binary search on the sorted list
+        relocs_in_block = bisect.bisect_left(relocation_addresses, end) - bisect.bisect_left(relocation_addresses, start)
         if relocs_in_block < expected_relocs:
             filtered_ranges.append((start, end))
     return filtered_ranges
@@ -168,34 +216,40 @@ def filter_blocks_by_relocations(ranges, relocation_addresses):
 @brief Retrieves basic block address ranges from a binary file.
 @param binary_path The path to the binary file.
 @param limit_factor The minimum size for a block to be included.
-@return A list of address ranges (start, end) for basic blocks.
+@param project An already loaded angr Project for the binary (optional).
+@param cfg An already computed CFGFast result for the project (optional).
+@return A sorted list of address ranges (start, end) for basic blocks.
 """
-def get_basic_block_ranges(binary_path, limit_factor):
-    project = angr.Project(binary_path, auto_load_libs=False)
+def get_basic_block_ranges(binary_path, limit_factor, project=None, cfg=None):
+    if project is None:
+        project = load_project(binary_path)
     image_base = project.loader.main_object.min_addr
-    cfg = project.analyses.CFGFast()
+    if cfg is None:
+        cfg = build_cfg(project)
     address_ranges = []
     jump_targets = set()
 
     for node in cfg.nodes():
         for successor in cfg.get_successors(node):
             jump_targets.add(successor.addr)
+    jump_targets = sorted(jump_targets)
 
     for node in cfg.nodes():
         block_start = node.addr
         block_end = node.addr + node.size
 
-        for target in jump_targets:
-            if block_start < target < block_end:
-                if target - block_start >= limit_factor:
-                    address_ranges.append((block_start, target))
-                block_start = target
+        # Only the targets strictly inside the block can split it
+        first = bisect.bisect_right(jump_targets, block_start)
+        last = bisect.bisect_left(jump_targets, block_end, first)
+        for target in jump_targets[first:last]:
+            if target - block_start >= limit_factor:
+                address_ranges.append((block_start - image_base, target - image_base))
+            block_start = target
 
         if block_end - block_start >= limit_factor:
-            address_ranges.append((block_start, block_end))
+            address_ranges.append((block_start - image_base, block_end - image_base))
 
-    address_ranges = [(start - image_base, end - image_base) for start, end in address_ranges]
-    address_ranges.sort(key=lambda x: x[0])
+    address_ranges.sort()
     return address_ranges
 
 """
@@ -204,9 +258,9 @@ def get_basic_block_ranges(binary_path, limit_factor):
 @param limit_factor The minimum size for a block to be disassembled and printed.
 """
 def disassemble_and_print_blocks(binary_path, limit_factor):
-    project = angr.Project(binary_path, auto_load_libs=False)
+    project = load_project(binary_path)
     image_base = project.loader.main_object.min_addr
-    cfg = project.analyses.CFGFast()
+    cfg = build_cfg(project)
 
     for node in cfg.nodes():
         block_size = node.size
@@ -226,31 +280,43 @@ IV_SIZE = 16
 @brief Encrypts data using AES-CTR mode.
 @param data The data to be encrypted.
 @param aes_key The AES key for encryption.
-@return The encrypted data.
+@return The encrypted data as a bytearray.
 """
 def encrypt_data(data, aes_key):
-    backend = default_backend()
-    cipher = Cipher(algorithms.AES(aes_key), modes.CTR(iv), backend=backend)
+    cipher = Cipher(algorithms.AES(aes_key), ctr_mode, backend=backend)
     encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(data) + encryptor.finalize()
+    # update_into requires room for one extra AES block; CTR is a stream mode so finalize() adds nothing
+    encrypted_data = bytearray(len(data) + algorithms.AES.block_size // 8 - 1)
+    written = encryptor.update_into(data, encrypted_data)
+    del encrypted_data[written:]
     return encrypted_data
 
 """
-@brief Generates a key using HKDF.
-@param address The address used in key generation.
+@brief Reads the key generation data from a license file.
 @param file_name The name of the file containing key generation data.
-@return The generated key.
+@return A tuple (pc_id, key_bytes).
 """
-def generate_key(address, file_name):
+def read_license(file_name):
     with open(file_name, 'rb') as file:
         pc_id = file.read(PC_ID_LENGTH)
         key_bytes = file.read(AES_KEY_LENGTH)
-        address_bytes = address.to_bytes(8, byteorder='little')
-        
-        print_hex_format(address_bytes)
-        print_hex_format(hkdf(address_bytes, key_bytes, pc_id, AES_KEY_LENGTH))
-        
-        return hkdf(address_bytes, key_bytes, pc_id, AES_KEY_LENGTH)
+    return pc_id, key_bytes
+
+"""
+@brief Generates a key using HKDF.
+@param address The address used in key generation.
+@param pc_id The PC ID read from the license file.
+@param key_bytes The key material read from the license file.
+@return The generated key.
+"""
+def generate_key(address, pc_id, key_bytes):
+    address_bytes = address.to_bytes(8, byteorder='little')
+    key = hkdf(address_bytes, key_bytes, pc_id, AES_KEY_LENGTH)
+
+    print_hex_format(address_bytes)
+    print_hex_format(key)
+
+    return key
 
 """
 @brief Calculates the raw offset between virtual and raw addresses for the text section.
@@ -273,29 +339,21 @@ def get_raw_offset(project):
 def enc_blocks(file_name, blocks):
     out_file_name = file_name + "_out.exe"
     shutil.copyfile(file_name, out_file_name)
-    project = angr.Project(file_name, auto_load_libs=False)
     raw_factor = int(get_text_section_virtual_address(file_name), 16) - get_text_section_addresses(file_name)[0]
-    blocks = sorted(blocks)
-    with open(out_file_name, "r+b") as out_file, open(file_name, "rb") as read_file:
-        current_position = 0
+    pc_id, key_bytes = read_license("License.dat")
+    # The copy already holds every unencrypted byte, so only the blocks are overwritten in place.
+    # Plaintext is still taken from the original file in case two blocks overlap.
+    # Both files are only accessed through their maps, so no Python-level buffering is needed.
+    with open(out_file_name, "r+b", buffering=0) as out_file, open(file_name, "rb", buffering=0) as read_file, \
+            mmap.mmap(out_file.fileno(), 0) as out_map, \
+            mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ) as read_map:
         for (start_block, end_block) in blocks:
             start_raw = start_block - raw_factor
-            print(f"raw address {hex(start_raw)}")
             end_raw = end_block - raw_factor
-            if start_raw > current_position:
-                read_length = start_raw - current_position
-                out_file.write(read_file.read(read_length))
-                current_position = start_raw
-            read_file.seek(start_raw, 0)
-            block_to_encrypt = read_file.read(end_raw - start_raw)
-            cur_key = generate_key(start_block, "License.dat")
-            encrypted_block = encrypt_data(block_to_encrypt, cur_key)
-            out_file.seek(start_raw, 0)
-            out_file.write(encrypted_block)
-            current_position = end_raw
-        remaining_size = os.path.getsize(file_name) - current_position
-        if remaining_size > 0:
-            out_file.write(read_file.read(remaining_size))
+            print(f"raw address {hex(start_raw)}")
+            cur_key = generate_key(start_block, pc_id, key_bytes)
+            out_map[start_raw:end_raw] = encrypt_data(read_map[start_raw:end_raw], cur_key)
+        out_map.flush()
     return out_file_name
 
 """
@@ -304,22 +362,23 @@ def enc_blocks(file_name, blocks):
 """
 def write_blocks_file(blocks):
     block_file_name = dir + "blocks_list.bin"
+    # Each block is stored as two little-endian unsigned 64-bit values: start, end
+    values = [address for block in blocks for address in block]
     with open(block_file_name, 'wb') as block_file:
-        for start_address, end_address in blocks:
-            start_bytes = start_address.to_bytes(8, 'little', signed=False)
-            end_bytes = end_address.to_bytes(8, 'little', signed=False)
-            block_file.write(start_bytes)
-            block_file.write(end_bytes)
+        block_file.write(struct.pack(f'<{len(values)}Q', *values))
 
 """
 @brief Finds dynamic jumps and calls in a 64-bit executable.
 @param exe_path The path to the executable file.
+@param project An already loaded angr Project for the executable (optional).
+@param cfg An already computed CFGFast result for the project (optional).
 @return A list of addresses of instructions performing dynamic jumps or calls.
 """
-def find_dynamic_jumps_calls_64bit(exe_path):
-    project = angr.Project(exe_path, auto_load_libs=False)
-    entry = project.factory.entry_state()
-    cfg = project.analyses.CFGFast()
+def find_dynamic_jumps_calls_64bit(exe_path, project=None, cfg=None):
+    if project is None:
+        project = load_project(exe_path)
+    if cfg is None:
+        cfg = build_cfg(project)
     image_base = project.loader.main_object.min_addr
     executable_sections = [sec for sec in project.loader.main_object.sections if sec.is_executable]
 
@@ -334,17 +393,20 @@ def find_dynamic_jumps_calls_64bit(exe_path):
     for addr, function in cfg.functions.items():
         for block in function.blocks:
             for instruction in block.capstone.insns:
-                if instruction.insn.mnemonic.startswith('j') or instruction.insn.mnemonic == 'call':
-                    op_str = instruction.insn.op_str
-                    if any(reg in op_str for reg in ['rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rsp', 'rbp', 'r8', 'r9', 'r10', 'r11', 'r12', 'r13', 'r14', 'r15']):
+                insn = instruction.insn
+                if not (insn.group(CS_GRP_JUMP) or insn.group(CS_GRP_CALL)) or not insn.operands:
+                    continue
+                operand = insn.operands[0]
+                if operand.type == CS_OP_REG:
+                    if operand.reg in DYNAMIC_REGS:
+                        dynamic_instructions.append(instruction.address - image_base)
+                elif operand.type == CS_OP_MEM:
+                    mem = operand.mem
+                    # Any base or index register means the target is only known at run time. This includes
+                    # rip-relative slots: the displacement is relative to the next instruction and the slot
+                    # holds a pointer (import or function table), so it is kept as dynamic.
+                    if mem.base != 0 or mem.index != 0 or text_start <= mem.disp <= text_end:
                         dynamic_instructions.append(instruction.address - image_base)
-                    elif op_str.startswith('qword ptr'):
-                        try:
-                            target_addr = int(op_str.split('[')[-1].split(']')[0], 16)
-                            if text_start <= target_addr <= text_end:
-                                dynamic_instructions.append(instruction.address - image_base)
-                        except ValueError:
-                            dynamic_instructions.append(instruction.address - image_base)
     return dynamic_instructions
 
 """
@@ -354,9 +416,7 @@ def find_dynamic_jumps_calls_64bit(exe_path):
 def write_call_address_file(addresses):
     block_file_name = dir+"call_address_list.bin"
     with open(block_file_name, 'wb') as block_file:
-        for address in addresses:
-            tmp = address.to_bytes(8, 'little', signed=False)
-            block_file.write(tmp)
+        block_file.write(struct.pack(f'<{len(addresses)}Q', *addresses))
 
 """
 @brief Retrieves address ranges for .data and .rdata sections.
@@ -405,16 +465,19 @@ def main(argc, argv):
         return
     binary_path = argv[1]
     limit_factor = int(argv[2]) if argc == 3 else 10
+    # Load the binary and build its CFG once, every analysis below shares them
+    project = load_project(binary_path)
+    cfg = build_cfg(project)
     # Get the address ranges of basic blocks
-    reallocation_table = get_relocation_addresses(binary_path)
+    reallocation_table = get_relocation_addresses(binary_path, project)
     for addr in reallocation_table:
         print(addr)
-    ranges = get_basic_block_ranges(binary_path, limit_factor)
+    ranges = get_basic_block_ranges(binary_path, limit_factor, project, cfg)
+    # Filtering keeps the order, so the ranges are still sorted
     ranges = filter_blocks_by_relocations(ranges, reallocation_table)
-    ranges = sorted(ranges)
     enc_blocks(binary_path, ranges)
     write_blocks_file(ranges)
-    dynamic_jumps = find_dynamic_jumps_calls_64bit(binary_path)
+    dynamic_jumps = find_dynamic_jumps_calls_64bit(binary_path, project, cfg)
     write_call_address_file(dynamic_jumps)
     file_names = [binary_path + "_out.exe", "public.pem", "License.dat", "Activation_Program.exe", "blocks_list.bin", "call_address_list.bin"]
     copy_files_to_out(file_names)